@@ -8,6 +8,18 @@ import requests
 import base64
 import argparse
 import logging
+import mmap
+import re
+import struct
+import hashlib
+import io
+import random
+import shutil
+import tarfile
+import zipfile
+import fnmatch
+from urllib.parse import urlparse
+from collections import namedtuple
 from tqdm import tqdm  # For progress bar
 
 # For keyboard listener
@@ -20,9 +32,37 @@ except ImportError:
     import pynput
     from pynput import keyboard
 
+# For the image quality gate
+try:
+    import numpy as np
+except ImportError:
+    print("The 'numpy' module is required for the image quality gate. Installing it now...")
+    os.system(f"{sys.executable} -m pip install numpy")
+    import numpy as np
+try:
+    from PIL import Image
+except ImportError:
+    print("The 'Pillow' module is required for the image quality gate. Installing it now...")
+    os.system(f"{sys.executable} -m pip install Pillow")
+    from PIL import Image
+
 paused = False  # Global variable to control pause state
 keyboard_listener = None  # Global variable for keyboard listener
 
+# Settings shared by every request in a run
+GenerationSettings = namedtuple('GenerationSettings', [
+    'model', 'sampling_method', 'scheduler', 'sampling_steps', 'width', 'height',
+    'cfg_scale', 'seed', 'api_endpoint'
+])
+
+# One txt2img request: a single iteration of one character or scene
+GenerationJob = namedtuple('GenerationJob', [
+    'story_name', 'prompt_type', 'item_name', 'item_dir', 'iteration',
+    'num_images', 'seed', 'prompt', 'negative_prompt', 'priority'
+])
+
+DEFAULT_SECONDS_PER_MEGAPIXEL_STEP = 0.4  # Used until there is recorded history
+
 def on_press(key):
     global paused
     try:
@@ -53,12 +93,27 @@ def load_sd_settings():
     with open(sd_settings_path, 'r') as f:
         return json.load(f)
 
-def load_prompts(file_path):
+def iter_prompt_blocks(file_path):
+    """Yield the '---' separated blocks of a prompt file one at a time."""
     if not os.path.exists(file_path):
-        return []
+        return
     with open(file_path, 'r', encoding='utf-8') as f:
-        content = f.read()
-    return [block.strip() for block in content.split('---') if block.strip()]
+        lines = []
+        for line in f:
+            if '---' in line:
+                # A separator may share its line with text, as str.split('---') allowed
+                parts = line.split('---')
+                lines.append(parts[0])
+                for part in parts[1:]:
+                    block = ''.join(lines).strip()
+                    if block:
+                        yield block
+                    lines = [part]
+            else:
+                lines.append(line)
+        block = ''.join(lines).strip()
+        if block:
+            yield block
 
 def parse_prompt_block(block):
     lines = block.strip().split('\n')
@@ -89,17 +144,14 @@ def parse_prompt_block(block):
     return data
 
 def create_prompts(prompt_type, folder_path):
+    """Yield the parsed prompt blocks for characters or scenes in a story folder."""
     if prompt_type == 'character':
         prompts_file = os.path.join(folder_path, 'characters.txt')
     else:
         prompts_file = os.path.join(folder_path, 'scenes.txt')
 
-    prompt_blocks = load_prompts(prompts_file)
-    prompts = []
-    for block in prompt_blocks:
-        data = parse_prompt_block(block)
-        prompts.append(data)
-    return prompts
+    for block in iter_prompt_blocks(prompts_file):
+        yield parse_prompt_block(block)
 
 def get_available_models(sd_models_path):
     model_extensions = ('.ckpt', '.safetensors', '.pt')
@@ -115,15 +167,216 @@ def get_available_loras(lora_dir):
     loras = [f for f in os.listdir(lora_dir) if os.path.isfile(os.path.join(lora_dir, f)) and f.lower().endswith(lora_extensions)]
     return loras
 
-def select_loras(loras):
+MODEL_INDEX_VERSION = 1  # Bump when describe_model_file changes so cached entries are rebuilt
+
+def load_model_index(index_path):
+    """Load the cached model metadata index, keyed by absolute file path."""
+    if not os.path.exists(index_path):
+        return {}
+    try:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Warning: could not read model index '{index_path}': {e}")
+        return {}
+
+def save_model_index(index_path, index):
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    with open(index_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=4)
+
+SAFETENSORS_MAX_HEADER_BYTES = 100 * 1024 * 1024  # Limit set by the safetensors format
+
+def read_safetensors_header(file_path):
+    """Read the JSON header of a .safetensors file without touching the tensor data."""
+    with open(file_path, 'rb') as f:
+        # Only the pages holding the header are actually read from disk
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if len(mm) < 8:
+                raise ValueError("file is too small to be a safetensors file")
+            header_len = struct.unpack('<Q', mm[:8])[0]
+            if header_len > len(mm) - 8:
+                raise ValueError("header length exceeds file size")
+            if header_len > SAFETENSORS_MAX_HEADER_BYTES:
+                raise ValueError("header length exceeds the 100 MB safetensors limit")
+            return json.loads(mm[8:8 + header_len].decode('utf-8'))
+
+def compute_fast_hash(file_path):
+    """Short model hash as used by the WebUI: sha256 of 64 KiB read at a 1 MiB offset.
+
+    Files smaller than the offset (small LoRAs, embeddings) are hashed from the
+    start instead, so they do not all share the hash of an empty read.
+    """
+    m = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size > 0x100000:
+            f.seek(0x100000)
+        m.update(f.read(0x10000))
+    return m.hexdigest()[0:8]
+
+def normalize_architecture(text):
+    """Map the various base model names found in metadata onto sd1/sd2/sdxl/sd3/flux."""
+    text = str(text).lower()
+    if 'flux' in text:
+        return 'flux'
+    if 'xl' in text:
+        return 'sdxl'
+    if 'v3' in text or 'sd3' in text:
+        return 'sd3'
+    if 'v2' in text or 'sd2' in text:
+        return 'sd2'
+    if 'v1' in text or 'sd1' in text:
+        return 'sd1'
+    return None
+
+def detect_architecture(header):
+    """Guess the base architecture of a checkpoint or LoRA from its header."""
+    metadata = header.get('__metadata__', {})
+    for key in ('modelspec.architecture', 'ss_base_model_version'):
+        if key in metadata:
+            architecture = normalize_architecture(metadata[key])
+            if architecture:
+                return architecture
+    if metadata.get('ss_v2') == 'True':
+        return 'sd2'
+
+    # Fall back to tensor names
+    keys = [k for k in header if k != '__metadata__']
+    if any(k.startswith(('conditioner.embedders.1.', 'lora_te1_', 'lora_te2_')) for k in keys):
+        return 'sdxl'
+    if any('double_blocks' in k for k in keys):
+        return 'flux'
+    if any('joint_blocks' in k for k in keys):
+        return 'sd3'
+    if any(k.startswith('cond_stage_model.model.') for k in keys):
+        return 'sd2'
+    if any(k.startswith(('cond_stage_model.transformer.', 'lora_te_')) for k in keys):
+        # LoRAs trained on SD 2.x use the same prefixes and are caught by ss_v2 above
+        return 'sd1'
+    return 'unknown'
+
+def parse_resolution(metadata):
+    """Return the training resolution recorded in the metadata as [width, height], if any."""
+    for key in ('modelspec.resolution', 'ss_resolution'):
+        value = metadata.get(key)
+        if value:
+            numbers = [int(n) for n in re.findall(r'\d+', str(value))]
+            if len(numbers) == 1:
+                return [numbers[0], numbers[0]]
+            if len(numbers) >= 2:
+                return numbers[:2]
+    return None
+
+def parse_trigger_words(metadata, max_words=5):
+    """Return the trigger phrase, or the most frequent training tags, from the metadata."""
+    trigger_phrase = metadata.get('modelspec.trigger_phrase')
+    if trigger_phrase:
+        return [word.strip() for word in trigger_phrase.split(',') if word.strip()]
+    tag_frequency = metadata.get('ss_tag_frequency')
+    if not tag_frequency:
+        return []
+    try:
+        datasets = json.loads(tag_frequency)
+    except ValueError:
+        return []
+    counts = {}
+    for tags in datasets.values():
+        for tag, count in tags.items():
+            tag = tag.strip()
+            counts[tag] = counts.get(tag, 0) + count
+    return sorted(counts, key=counts.get, reverse=True)[:max_words]
+
+def describe_model_file(file_path):
+    """Extract architecture, resolution, trigger words and hash for a model file."""
+    info = {
+        "architecture": 'unknown',
+        "resolution": None,
+        "trigger_words": [],
+        "hash": None
+    }
+    try:
+        info["hash"] = compute_fast_hash(file_path)
+    except OSError as e:
+        print(f"Warning: could not hash '{file_path}': {e}")
+    # .ckpt and .pt files are pickles and cannot be inspected without loading them
+    if file_path.lower().endswith('.safetensors'):
+        try:
+            header = read_safetensors_header(file_path)
+        except (OSError, ValueError) as e:
+            print(f"Warning: could not read safetensors header of '{file_path}': {e}")
+            return info
+        metadata = header.get('__metadata__', {})
+        info["architecture"] = detect_architecture(header)
+        info["resolution"] = parse_resolution(metadata)
+        info["trigger_words"] = parse_trigger_words(metadata)
+    return info
+
+def index_model_files(directory, filenames, index):
+    """Return metadata for each file, reusing cached entries whose size and mtime still match.
+
+    New or changed entries are written into index in place.
+    """
+    infos = {}
+    for filename in filenames:
+        file_path = os.path.abspath(os.path.join(directory, filename))
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            continue
+        entry = index.get(file_path)
+        if (entry is None or entry.get('version') != MODEL_INDEX_VERSION
+                or entry.get('size') != stat.st_size or entry.get('mtime') != stat.st_mtime):
+            entry = describe_model_file(file_path)
+            entry['version'] = MODEL_INDEX_VERSION
+            entry['size'] = stat.st_size
+            entry['mtime'] = stat.st_mtime
+            index[file_path] = entry
+        infos[filename] = entry
+    return infos
+
+def format_model_info(info):
+    if not info:
+        return ''
+    details = [info.get('architecture') or 'unknown']
+    if info.get('hash'):
+        details.append(info['hash'])
+    return f" [{', '.join(details)}]"
+
+def check_model_compatibility(model_name, model_info, selected_loras, lora_infos, width, height):
+    """Return a list of warnings about LoRAs or image sizes that do not suit the checkpoint."""
+    warnings = []
+    model_architecture = (model_info or {}).get('architecture', 'unknown')
+    for lora in selected_loras:
+        lora_info = lora_infos.get(lora.get('file'), {})
+        lora_architecture = lora_info.get('architecture', 'unknown')
+        if 'unknown' in (model_architecture, lora_architecture):
+            continue
+        if lora_architecture != model_architecture:
+            warnings.append(f"LoRA '{lora['name']}' was trained for {lora_architecture}, but model '{model_name}' is {model_architecture}.")
+
+    native_sizes = {'sd1': 512, 'sd2': 768, 'sdxl': 1024, 'sd3': 1024, 'flux': 1024}
+    resolution = (model_info or {}).get('resolution')
+    if not resolution and model_architecture in native_sizes:
+        resolution = [native_sizes[model_architecture]] * 2
+    if resolution:
+        ratio = (width * height) / float(resolution[0] * resolution[1])
+        if ratio < 0.5 or ratio > 2.0:
+            warnings.append(f"Image size {width}x{height} is far from the {resolution[0]}x{resolution[1]} resolution model '{model_name}' expects.")
+    return warnings
+
+def select_loras(loras, lora_infos=None):
     """Prompt the user to select one or more LoRAs from the available list and specify their weights."""
+    lora_infos = lora_infos or {}
     if not loras:
         print("No LoRA models found.")
         return []
     
     print("\nAvailable LoRA Models:")
     for idx, lora in enumerate(loras, start=1):
-        print(f"{idx}: {lora}")
+        info = lora_infos.get(lora)
+        print(f"{idx}: {lora}{format_model_info(info)}")
+        if info and info.get('trigger_words'):
+            print(f"     Trigger words: {', '.join(info['trigger_words'])}")
     print("0: No LoRA")
     
     selected_loras = []
@@ -158,7 +411,7 @@ def select_loras(loras):
                     print("Weight must be between 0.0 and 1.0. Please try again.")
             except ValueError:
                 print("Invalid input. Please enter a numeric value between 0.0 and 1.0.")
-        loras_with_weights.append({"name": os.path.splitext(lora)[0], "weight": weight})
+        loras_with_weights.append({"name": os.path.splitext(lora)[0], "weight": weight, "file": lora})
     
     return loras_with_weights
 
@@ -201,9 +454,9 @@ def check_stable_diffusion_running(api_endpoint):
     return False
 
 def generate_json_files(prompts, prompt_type, story_name, default_seed, num_images, num_iterations, output_dir):
+    """Write prompt.json for each item as it is reached and yield (item_name, item_dir, data)."""
     base_dir = os.path.join(output_dir, story_name, 'Characters' if prompt_type == 'character' else 'Scenes')
     os.makedirs(base_dir, exist_ok=True)
-    json_files = []
     for data in prompts:
         item_name = data.get('Name', 'Unnamed').replace(' ', '_')
         item_dir = os.path.join(base_dir, item_name)
@@ -217,131 +470,965 @@ def generate_json_files(prompts, prompt_type, story_name, default_seed, num_imag
         data_without_name['Seed'] = default_seed
         with open(prompt_path, 'w', encoding='utf-8') as f:
             json.dump(data_without_name, f, indent=4)
-        json_files.append(prompt_path)
-    return json_files
-
-def generate_images(settings, prompt_type, story_name, num_images, num_iterations, output_dir, character_prompts, selected_loras, lora_dir):
-    api_url = settings.get('api_endpoint', 'http://localhost:7860') + '/sdapi/v1/txt2img'
-    headers = {'Content-Type': 'application/json'}
+        yield item_name, item_dir, data_without_name
+
+def append_phrase(prompt, text):
+    """Append text to a prompt as a separate comma-separated phrase."""
+    text = text.strip()
+    if not text:
+        return prompt
+    prompt = prompt.rstrip()
+    if not prompt:
+        return text
+    if prompt[-1] not in ',.;':
+        prompt += ','
+    return f"{prompt} {text}"
+
+def build_positive_prompt(prompt_type, data, character_descriptions, selected_loras):
+    positive_prompt = data.get('Positive prompt', '')
+
+    # Include character details in the prompt
+    if prompt_type == 'character':
+        # For character images, use the character's own description
+        character_description = data.get('Description', '')
+        positive_prompt = append_phrase(positive_prompt, character_description)
+    elif prompt_type == 'scene':
+        # For scenes, include descriptions of characters present
+        for character_name in data.get('Characters', []):
+            if character_name in character_descriptions:
+                positive_prompt = append_phrase(positive_prompt, character_descriptions[character_name])
+
+    # Append LoRA references with weights to the positive prompt
+    if selected_loras:
+        # Format: " <lora:LoRA_Name:Weight> <lora:LoRA_Name:Weight> ..."
+        lora_references = " ".join([f"<lora:{lora['name']}:{lora['weight']}>" for lora in selected_loras])
+        positive_prompt += f" {lora_references}"
+
+    # Use unique identifier or token if available
+    unique_identifier = data.get('Unique Identifier', '')
+    if unique_identifier:
+        positive_prompt = append_phrase(positive_prompt, unique_identifier)
+    return positive_prompt
+
+CLIP_CHUNK_TOKENS = 75
+CHUNK_TRIM_TOKENS = 10  # Overflow small enough that trimming the prompt would save a chunk
+EXTRA_NETWORK_PATTERN = re.compile(r'<[^<>:]+:[^<>]*>')
+ATTENTION_WEIGHT_PATTERN = re.compile(r':\s*-?[0-9.]+\s*\)')
+CLIP_WORD_PATTERN = re.compile(r"'s|'t|'re|'ve|'m|'ll|'d|[^\W\d_]+|\d|[^\s\w]+", re.IGNORECASE)
+
+def estimate_token_count(text):
+    """Roughly estimate the number of CLIP tokens the WebUI will produce for text.
+
+    LoRA/extra network tags and attention syntax are removed first, as the WebUI
+    strips them before tokenizing. Long words are counted as several BPE tokens.
+    """
+    text = EXTRA_NETWORK_PATTERN.sub(' ', text)
+    text = ATTENTION_WEIGHT_PATTERN.sub(' ', text)
+    text = re.sub(r'[()\[\]]', ' ', text)
+    tokens = 0
+    for word in CLIP_WORD_PATTERN.findall(text.lower()):
+        tokens += 1 + len(word) // 10
+    return tokens
+
+def estimate_prompt_budget(prompt):
+    """Return (tokens, chunks) for a prompt, honouring the WebUI's BREAK keyword."""
+    tokens = 0
+    chunks = 0
+    for segment in re.split(r'\bBREAK\b', prompt):
+        segment_tokens = estimate_token_count(segment)
+        tokens += segment_tokens
+        chunks += max(1, -(-segment_tokens // CLIP_CHUNK_TOKENS))
+    return tokens, chunks
+
+def split_prompt_phrases(text):
+    """Split a prompt into alternating phrases and separators.
+
+    Commas, semicolons and newlines separate phrases, and so does a period
+    followed by whitespace or the end of the prompt, so decimals such as 2.5 stay
+    intact. Nothing inside (...) or [...] is split, which keeps attention
+    weights like (masterpiece:1.2) whole.
+    """
+    parts = []
+    phrase_start = 0
+    depth = 0
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if char in '([':
+            depth += 1
+        elif char in ')]':
+            depth = max(0, depth - 1)
+        elif depth == 0 and (char in ',;\n' or (char == '.' and (i + 1 == len(text) or text[i + 1].isspace()))):
+            separator_end = i + 1
+            while separator_end < len(text) and text[separator_end] in ',.;\n':
+                separator_end += 1
+            parts.append(text[phrase_start:i])
+            parts.append(text[i:separator_end])
+            phrase_start = i = separator_end
+            continue
+        i += 1
+    parts.append(text[phrase_start:])
+    return parts
+
+def normalize_phrase(phrase):
+    return ' '.join(re.sub(r'[^\w\s]', ' ', phrase.lower()).split())
+
+def dedupe_prompt(prompt):
+    """Remove comma/sentence separated phrases that already appeared earlier in the prompt.
+
+    LoRA tags are never removed. Returns (deduped_prompt, removed_phrases).
+
+    >>> dedupe_prompt('(masterpiece:1.2), (best quality:1.2), a man, (masterpiece:1.2)')
+    ('(masterpiece:1.2), (best quality:1.2), a man', ['(masterpiece:1.2)'])
+    >>> dedupe_prompt('Age 2.5, Age 3.5')
+    ('Age 2.5, Age 3.5', [])
+    """
+    # Keep LoRA tags out of the phrase split, their weights contain dots
+    extra_networks = EXTRA_NETWORK_PATTERN.findall(prompt)
+    text = EXTRA_NETWORK_PATTERN.sub(' ', prompt)
+
+    parts = split_prompt_phrases(text)
+    seen = set()
+    kept = []
+    removed = []
+    for i in range(0, len(parts), 2):
+        phrase = parts[i]
+        separator = parts[i + 1] if i + 1 < len(parts) else ''
+        normalized = normalize_phrase(phrase)
+        if normalized and normalized in seen:
+            removed.append(phrase.strip())
+            continue
+        if normalized:
+            seen.add(normalized)
+        kept.append(phrase + separator)
+
+    deduped = ' '.join(''.join(kept).split()).rstrip(',;')
+    if extra_networks:
+        deduped = f"{deduped} {' '.join(extra_networks)}".strip()
+    return deduped, removed
+
+def new_prompt_budget_report():
+    return {
+        "items": 0,
+        "items_over_one_chunk": 0,
+        "items_near_boundary": 0,
+        "chunks_before": 0,
+        "chunks_after": 0,
+        "duplicates": 0
+    }
 
-    base_dir = os.path.join(output_dir, story_name, 'Characters' if prompt_type == 'character' else 'Scenes')
-    if not os.path.exists(base_dir):
-        print(f"No {prompt_type}s to process in {story_name}.")
+def analyze_prompt_budget(jobs, dedupe, report):
+    """Estimate token and chunk counts for each item's prompts as jobs pass through.
+
+    Duplicate phrases are always reported and, when dedupe is true, removed from
+    the job prompts. Prompts that cross a 75-token chunk boundary are logged with
+    the number of tokens spilling into the last chunk, and printed when only a few
+    tokens would need trimming to save a chunk. Totals are accumulated into report.
+    """
+    current_item = None
+    prompts = None
+    for job in jobs:
+        # Items can share a folder (two blocks without a Name), so include the prompts
+        item_key = (job.item_dir, job.prompt, job.negative_prompt)
+        if item_key != current_item:
+            current_item = item_key
+            report["items"] += 1
+            prompts = []
+            for label, prompt in (('Positive', job.prompt), ('Negative', job.negative_prompt)):
+                tokens, chunks = estimate_prompt_budget(prompt)
+                deduped, removed = dedupe_prompt(prompt)
+                if removed:
+                    report["duplicates"] += len(removed)
+                    action = "Removed" if dedupe else "Found"
+                    message = f"{action} {len(removed)} duplicate phrase(s) in {label.lower()} prompt of {job.item_name}: {'; '.join(removed)}"
+                    print(message)
+                    logging.info(message)
+                    if dedupe:
+                        prompt = deduped
+                new_tokens, new_chunks = estimate_prompt_budget(prompt)
+                report["chunks_before"] += chunks
+                report["chunks_after"] += new_chunks
+                if new_chunks > 1:
+                    if label == 'Positive':
+                        report["items_over_one_chunk"] += 1
+                    overflow = new_tokens - CLIP_CHUNK_TOKENS * (new_chunks - 1)
+                    message = (f"{label} prompt of {job.item_name} is ~{new_tokens} tokens ({new_chunks} chunks), "
+                               f"{overflow} token(s) past the {CLIP_CHUNK_TOKENS * (new_chunks - 1)}-token boundary")
+                    logging.info(message)
+                    if overflow <= CHUNK_TRIM_TOKENS:
+                        report["items_near_boundary"] += 1
+                        print(message)
+                prompts.append(prompt)
+        if dedupe:
+            job = job._replace(prompt=prompts[0], negative_prompt=prompts[1])
+        yield job
+
+def print_prompt_budget_report(report, dedupe):
+    if not report["items"]:
         return
-    items = os.listdir(base_dir)
-    for item_name in items:
-        item_dir = os.path.join(base_dir, item_name)
-        prompt_path = os.path.join(item_dir, 'prompt.json')
-        if not os.path.exists(prompt_path):
-            continue
-        with open(prompt_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+    print("\nPrompt budget summary:")
+    print(f"  Items analyzed: {report['items']}")
+    print(f"  Items with positive prompts over one {CLIP_CHUNK_TOKENS}-token chunk: {report['items_over_one_chunk']}")
+    print(f"  Prompts within {CHUNK_TRIM_TOKENS} tokens of saving a chunk: {report['items_near_boundary']}")
+    print(f"  Duplicate phrases {'removed' if dedupe else 'found'}: {report['duplicates']}")
+    if dedupe:
+        print(f"  Estimated prompt chunks summed over items: {report['chunks_before']} before, {report['chunks_after']} after deduplication")
+    else:
+        print(f"  Estimated prompt chunks summed over items: {report['chunks_before']} (set \"dedupe_prompts\" to true in sd_settings.json to remove duplicates)")
 
-        seed = int(data.get('Seed', settings['seed']))
+def iter_item_jobs(settings, prompt_type, story_name, items, character_descriptions, selected_loras):
+    """Expand each (item_name, item_dir, data) into one job per iteration."""
+    for item_name, item_dir, data in items:
+        seed = int(data.get('Seed', settings.seed))
         if seed == -1:
-            seed = int(time.time())  # Use current time as seed if -1
-
-        print(f"\nGenerating images for {prompt_type}: {item_name}")
-        print(f"Settings:")
-        print(f"  Model: {settings['model']}")
-        if selected_loras:
-            lora_names = ', '.join([f"{lora['name']} ({lora['weight']})" for lora in selected_loras])
-            print(f"  LoRAs: {lora_names}")
-        else:
-            print(f"  LoRAs: None")
-        print(f"  Sampler: {settings['sampling_method']}")
-        print(f"  Scheduler: {settings['scheduler']}")
-        print(f"  Sampling Steps: {settings['sampling_steps']}")
-        print(f"  Width: {settings['width']}")
-        print(f"  Height: {settings['height']}")
-        print(f"  CFG Scale: {settings['cfg_scale']}")
-        print(f"  Seed: {seed}")
-        print(f"  Number of Images: {num_images}")
-        print(f"  Number of Iterations: {num_iterations}")
-
+            # Items may be expanded well before they are sent, so don't derive the seed from the clock
+            seed = random.randint(0, 2 ** 32 - 1)
+        num_images = int(data.get('Number of Images', 1))
+        num_iterations = int(data.get('Number of Iterations', 1))
+        # The prompt is built once and shared by all iterations of the item
+        positive_prompt = build_positive_prompt(prompt_type, data, character_descriptions, selected_loras)
+        negative_prompt = data.get('Negative prompt', '')
+        try:
+            priority = int(data.get('Priority', 0))
+        except ValueError:
+            print(f"Invalid priority for {item_name}, using 0.")
+            priority = 0
         for iteration in range(1, num_iterations + 1):
-            iteration_dir = os.path.join(item_dir, f'Iteration_{iteration}')
-            os.makedirs(iteration_dir, exist_ok=True)
-
-            positive_prompt = data.get('Positive prompt', '')
-            negative_prompt = data.get('Negative prompt', '')
-
-            # Include character details in the prompt
-            if prompt_type == 'character':
-                # For character images, use the character's own description
-                character_description = data.get('Description', '')
-                positive_prompt += f" {character_description}"
-            elif prompt_type == 'scene':
-                # For scenes, include descriptions of characters present
-                scene_characters = data.get('Characters', [])
-                for character_name in scene_characters:
-                    # Find the character's description
-                    character = next((c for c in character_prompts if c['Name'] == character_name), None)
-                    if character:
-                        character_description = character.get('Description', '')
-                        positive_prompt += f" {character_description}"
-
-            # Append LoRA references with weights to the positive prompt
-            if selected_loras:
-                # Format: " <lora:LoRA_Name:Weight> <lora:LoRA_Name:Weight> ..."
-                lora_references = " ".join([f"<lora:{lora['name']}:{lora['weight']}>" for lora in selected_loras])
-                positive_prompt += f" {lora_references}"
+            yield GenerationJob(story_name, prompt_type, item_name, item_dir, iteration,
+                                num_images, seed, positive_prompt, negative_prompt, priority)
 
-            # Use unique identifier or token if available
-            unique_identifier = data.get('Unique Identifier', '')
-            if unique_identifier:
-                positive_prompt += f" {unique_identifier}"
+def iter_jobs(settings, selected_folders, input_dir, output_dir, num_images, num_iterations, selected_loras):
+    """Lazily expand folders x items x iterations into GenerationJob records.
 
-            # Check for pause
-            while paused:
-                time.sleep(0.5)
+    A story's prompt blocks are parsed and ordered by order_items_for_cache
+    before its first job, but prompt.json files are written and iterations
+    expanded only as jobs are requested. Memory holds one parsed block per item
+    of the current story, and never grows with the number of jobs or stories.
+    """
+    for story_name in selected_folders:
+        folder_path = os.path.join(input_dir, story_name)
+
+        # Scenes only need the character descriptions, not the full prompt blocks
+        character_descriptions = {}
+        for data in create_prompts('character', folder_path):
+            character_descriptions[data.get('Name')] = data.get('Description', '')
+
+        blocks = [(prompt_type, data) for prompt_type in ('character', 'scene')
+                  for data in create_prompts(prompt_type, folder_path)]
+        blocks = order_items_for_cache(story_name, blocks, character_descriptions, selected_loras, num_iterations)
+        for prompt_type, data in blocks:
+            items = generate_json_files([data], prompt_type, story_name,
+                                        settings.seed, num_images, num_iterations, output_dir)
+            yield from iter_item_jobs(settings, prompt_type, story_name, items, character_descriptions, selected_loras)
+
+def estimate_cache_hits(runs):
+    """Count requests whose positive or negative prompt matches the previous request.
+
+    The WebUI keeps the conditioning of the last positive and negative prompt and
+    reuses each when the next request has the same text. runs yields
+    (prompt, negative_prompt, requests) for consecutive requests with the same
+    prompts. Returns (positive_hits, negative_hits, requests).
+    """
+    positive_hits = negative_hits = requests_made = 0
+    previous = None
+    for prompt, negative_prompt, requests_in_run in runs:
+        if requests_in_run <= 0:
+            continue
+        # Repeats within a run always hit
+        positive_hits += requests_in_run - 1
+        negative_hits += requests_in_run - 1
+        if previous is not None:
+            positive_hits += prompt == previous[0]
+            negative_hits += negative_prompt == previous[1]
+        requests_made += requests_in_run
+        previous = (prompt, negative_prompt)
+    return positive_hits, negative_hits, requests_made
+
+def format_cache_hit_rate(hits):
+    positive_hits, negative_hits, requests_made = hits
+    if not requests_made:
+        return "n/a"
+    return f"{100.0 * (positive_hits + negative_hits) / (2 * requests_made):.0f}%"
+
+def order_items_for_cache(story_name, blocks, character_descriptions, selected_loras, num_iterations):
+    """Order a story's (prompt_type, data) blocks so the WebUI can reuse prompt conditioning.
+
+    All jobs in a run share one checkpoint, so each story is a single checkpoint
+    group. Items sharing a negative prompt are clustered and items with identical
+    positive and negative prompts are placed next to each other; otherwise the
+    order of first appearance is kept. An item's iterations always run back to
+    back, so ordering items orders the jobs without expanding them.
+    """
+    negative_order = {}
+    positive_order = {}
+    keys = []
+    for prompt_type, data in blocks:
+        positive_prompt = build_positive_prompt(prompt_type, data, character_descriptions, selected_loras)
+        negative_prompt = data.get('Negative prompt', '')
+        negative_order.setdefault(negative_prompt, len(negative_order))
+        positive_order.setdefault((negative_prompt, positive_prompt), len(positive_order))
+        keys.append((negative_prompt, positive_prompt))
+
+    before = estimate_cache_hits((positive, negative, num_iterations) for negative, positive in keys)
+    order = sorted(range(len(blocks)), key=lambda i: (negative_order[keys[i][0]], positive_order[keys[i]]))
+    after = estimate_cache_hits((keys[i][1], keys[i][0], num_iterations) for i in order)
+    if blocks:
+        message = (f"{story_name}: expected conditioning cache hit rate {format_cache_hit_rate(after)} "
+                   f"({format_cache_hit_rate(before)} in file order), {len(negative_order)} distinct negative prompt(s)")
+        print(f"\n{message}")
+        logging.info(message)
+    return [blocks[i] for i in order]
+
+def cost_model_key(backend, sampler):
+    return f"{backend}|{sampler}"
+
+def cost_features(steps, width, height, batch_size, n_iter):
+    """Work done by one request, in megapixel-steps."""
+    return steps * width * height * batch_size * n_iter / 1e6
+
+def update_cost_model(cost_model, backend, sampler, x, seconds):
+    """Add one observed request to the running least-squares sums."""
+    for key in (cost_model_key(backend, sampler), '*'):
+        sums = cost_model.setdefault(key, [0, 0.0, 0.0, 0.0, 0.0])
+        sums[0] += 1
+        sums[1] += x
+        sums[2] += seconds
+        sums[3] += x * x
+        sums[4] += x * seconds
+
+def load_cost_model(history_path):
+    """Fit the cost model from the recorded generation history.
+
+    The model maps '<backend>|<sampler>' (and '*' for all requests) to running
+    sums for a least-squares fit of seconds = a + b * megapixel-steps.
+    """
+    cost_model = {}
+    if not os.path.exists(history_path):
+        return cost_model
+    with open(history_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                x = cost_features(record['steps'], record['width'], record['height'],
+                                  record.get('batch_size', 1), record.get('n_iter', 1))
+                update_cost_model(cost_model, record['backend'], record['sampler'], x, float(record['seconds']))
+            except (ValueError, KeyError, TypeError):
+                continue
+    return cost_model
+
+def record_generation_history(history_path, record):
+    with open(history_path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record) + '\n')
+
+def estimate_seconds(cost_model, backend, sampler, x):
+    """Estimate the latency of a request, preferring history for the same backend and sampler."""
+    for key in (cost_model_key(backend, sampler), '*'):
+        sums = cost_model.get(key)
+        if not sums or not sums[1]:
+            continue
+        n, sx, sy, sxx, sxy = sums
+        denominator = n * sxx - sx * sx
+        if n >= 2 and denominator > 1e-9:
+            slope = (n * sxy - sx * sy) / denominator
+            intercept = (sy - slope * sx) / n
+            if slope > 0 and intercept >= 0:
+                return intercept + slope * x
+        # Too little spread in the history for a line, fall back to the mean rate
+        return sy / sx * x
+    return DEFAULT_SECONDS_PER_MEGAPIXEL_STEP * x
+
+def estimate_job_seconds(cost_model, settings, job):
+    x = cost_features(settings.sampling_steps, settings.width, settings.height, 1, job.num_images)
+    return estimate_seconds(cost_model, settings.api_endpoint, settings.sampling_method, x)
+
+def schedule_jobs(jobs, settings, cost_model, deadline):
+    """Order jobs by priority and yield only those expected to finish before deadline.
+
+    Higher 'Priority' values run first. Within a priority level each story's jobs
+    stay together, in story order, and keep the order given by
+    order_items_for_cache, so iterations with identical prompts still run back
+    to back and the WebUI can reuse their conditioning. Stories only interleave
+    when they contain several priority levels; generate_images then suspends the
+    previous story's shard writer, closing its file, and appends to it when the
+    story comes back. Each job is re-estimated just before it is dispatched,
+    using the cost model as updated by the requests already made, and skipped
+    if it no longer fits in the remaining time. All jobs are held in memory so
+    they can be ordered.
+    """
+    planned = list(jobs)
+    story_order = {}
+    for job in planned:
+        story_order.setdefault(job.story_name, len(story_order))
+    # The sort is stable, so the cache ordering is kept within each story
+    planned.sort(key=lambda job: (-job.priority, story_order[job.story_name]))
+    available = max(0.0, deadline - time.time())
+    estimated_total = 0.0
+    expected_fit = 0
+    for job in planned:
+        estimate = estimate_job_seconds(cost_model, settings, job)
+        if estimated_total + estimate <= available:
+            estimated_total += estimate
+            expected_fit += 1
+    print(f"\nScheduled {len(planned)} jobs; about {expected_fit} are expected to finish "
+          f"within the {available / 60:.1f} minute budget.")
+    scheduled_hits = estimate_cache_hits((job.prompt, job.negative_prompt, 1) for job in planned)
+    print(f"Expected conditioning cache hit rate in scheduled order: {format_cache_hit_rate(scheduled_hits)}")
+
+    skipped = 0
+    for job in planned:
+        estimate = estimate_job_seconds(cost_model, settings, job)
+        if time.time() + estimate > deadline:
+            skipped += 1
+            logging.info(f"Skipping {job.item_name}, Iteration {job.iteration}: estimated {estimate:.1f}s exceeds the time budget")
+            continue
+        yield job
+    if skipped:
+        print(f"\nSkipped {skipped} of {len(planned)} jobs that would not finish within the time budget.")
+
+def print_item_settings(settings, job, num_iterations, selected_loras):
+    print(f"\nGenerating images for {job.prompt_type}: {job.item_name}")
+    print(f"Settings:")
+    print(f"  Model: {settings.model}")
+    if selected_loras:
+        lora_names = ', '.join([f"{lora['name']} ({lora['weight']})" for lora in selected_loras])
+        print(f"  LoRAs: {lora_names}")
+    else:
+        print(f"  LoRAs: None")
+    print(f"  Sampler: {settings.sampling_method}")
+    print(f"  Scheduler: {settings.scheduler}")
+    print(f"  Sampling Steps: {settings.sampling_steps}")
+    print(f"  Width: {settings.width}")
+    print(f"  Height: {settings.height}")
+    print(f"  CFG Scale: {settings.cfg_scale}")
+    print(f"  Seed: {job.seed}")
+    print(f"  Number of Images: {job.num_images}")
+    print(f"  Number of Iterations: {num_iterations}")
+
+def load_quality_settings(sd_settings):
+    """Return the quality gate thresholds from sd_settings.json, or None if the gate is disabled."""
+    if not sd_settings.get('quality_gate', True):
+        return None
+    return {
+        # Images whose brightest pixel is at or below this are treated as black (0-255)
+        "black_threshold": float(sd_settings.get('quality_black_threshold', 8)),
+        # Images with a brightness standard deviation below this are treated as blank
+        "blank_std_threshold": float(sd_settings.get('quality_blank_std_threshold', 3.0)),
+        # Perceptual hashes this many bits apart or closer are near-duplicates (0-64)
+        "duplicate_distance": int(sd_settings.get('quality_duplicate_distance', 4)),
+        # How many times degenerate images are requested again with a new seed
+        "max_retries": int(sd_settings.get('quality_max_retries', 2))
+    }
+
+def new_quality_report():
+    return {
+        "checked": 0,
+        "requeued": 0,
+        "dropped": 0,
+        "duplicates": 0
+    }
 
-            payload = {
-                "prompt": positive_prompt,
-                "negative_prompt": negative_prompt,
-                "steps": settings["sampling_steps"],
-                "cfg_scale": settings["cfg_scale"],
-                "width": settings["width"],
-                "height": settings["height"],
-                "sampler_name": settings["sampling_method"],
-                "seed": seed,
-                "batch_size": 1,
-                "n_iter": num_images,
-                "scheduler": settings["scheduler"],
-                "override_settings": {
-                    "sd_model_checkpoint": settings["model"]
+def compute_image_statistics(images):
+    """Decode a batch of PNG bytes or file paths and return (max, std, dhash, failed) arrays.
+
+    Images are reduced to 72x64 grayscale so the statistics and the 64-bit
+    difference hashes of the whole batch are computed with a handful of array ops.
+    Images that cannot be decoded are left black and flagged in failed.
+    """
+    pixels = np.zeros((len(images), 64, 72), dtype=np.float32)
+    failed = np.zeros(len(images), dtype=bool)
+    for i, img in enumerate(images):
+        try:
+            with Image.open(io.BytesIO(img) if isinstance(img, bytes) else img) as decoded:
+                pixels[i] = np.asarray(decoded.convert('L').resize((72, 64), Image.BILINEAR), dtype=np.float32)
+        except (OSError, ValueError) as e:
+            # Covers unidentified and truncated images
+            logging.warning(f"Could not decode generated image: {e}")
+            failed[i] = True
+    maxima = pixels.max(axis=(1, 2))
+    stds = pixels.std(axis=(1, 2))
+    # Average 8x8 pixel blocks down to 8x9 and compare horizontal neighbours
+    blocks = pixels.reshape(len(images), 8, 8, 9, 8).mean(axis=(2, 4))
+    hashes = np.packbits((blocks[:, :, 1:] > blocks[:, :, :-1]).reshape(len(images), 64), axis=1)
+    return maxima, stds, hashes, failed
+
+def check_image_quality(images, previous_hashes, quality):
+    """Classify a batch of images as degenerate (including undecodable) or near-duplicate.
+
+    previous_hashes holds the hashes already kept for the item. Returns boolean
+    arrays (degenerate, duplicate) and the hashes of the batch.
+    """
+    maxima, stds, hashes, failed = compute_image_statistics(images)
+    degenerate = failed | (maxima <= quality["black_threshold"]) | (stds < quality["blank_std_threshold"])
+
+    # Hamming distance of every new hash to every kept and new hash
+    candidates = np.concatenate([previous_hashes, hashes])
+    distances = np.unpackbits(hashes[:, None, :] ^ candidates[None, :, :], axis=2).sum(axis=2)
+    close = distances <= quality["duplicate_distance"]
+
+    duplicate = np.zeros(len(images), dtype=bool)
+    kept = np.ones(len(candidates), dtype=bool)
+    offset = len(previous_hashes)
+    for i in range(len(images)):
+        # Only compare against images that are kept and come before this one
+        earlier = kept[:offset + i]
+        if degenerate[i] or close[i, :offset + i][earlier].any():
+            duplicate[i] = not degenerate[i]
+            kept[offset + i] = False
+    return degenerate, duplicate, hashes
+
+def is_colocated(sd_settings, api_endpoint):
+    """Whether the WebUI can write straight into our output folders.
+
+    'colocated' in sd_settings.json may be true, false (the default) or "auto";
+    auto enables it when the API is on this machine and the WebUI folder exists.
+    """
+    colocated = sd_settings.get('colocated', False)
+    if not isinstance(colocated, str):
+        return bool(colocated)
+    # Accept quoted values too, so "false" is not read as true
+    colocated = colocated.strip().lower()
+    if colocated in ('true', 'yes', '1'):
+        return True
+    if colocated != 'auto':
+        if colocated not in ('false', 'no', '0', ''):
+            print(f"Unknown colocated setting '{colocated}', images will be sent over the API.")
+        return False
+    host = urlparse(api_endpoint).hostname
+    return host in ('localhost', '127.0.0.1', '::1') and os.path.isdir(sd_settings.get('sd_folder', ''))
+
+def save_image(source, img_path):
+    """Write PNG bytes to img_path, or move a file the WebUI saved itself."""
+    if isinstance(source, bytes):
+        with open(img_path, 'wb') as img_file:
+            img_file.write(source)
+        return
+    try:
+        # The staging folder is on the same drive, so this is a rename
+        os.replace(source, img_path)
+    except OSError:
+        shutil.move(source, img_path)
+
+# WebUI settings that make it save each image as a numbered PNG directly in the staging folder
+COLOCATED_OUTPUT_OPTIONS = {
+    "outdir_samples": "",
+    "save_to_dirs": False,
+    "samples_format": "png",
+    "save_images_add_number": True,
+    "grid_save": False
+}
+
+def set_colocated_output(api_endpoint, staging_dir):
+    """Point the WebUI's txt2img output folder at staging_dir.
+
+    The API reads the output folder from the WebUI settings before a request's
+    override_settings are applied, so it is changed through the options endpoint
+    for the whole run. Returns the previous values for restore_webui_options,
+    or None if the settings could not be changed.
+    """
+    options_url = f'{api_endpoint}/sdapi/v1/options'
+    previous = None
+    try:
+        response = requests.get(options_url)
+        response.raise_for_status()
+        current = response.json()
+        options = dict(COLOCATED_OUTPUT_OPTIONS, outdir_txt2img_samples=staging_dir)
+        previous = {key: current[key] for key in options if key in current}
+        logging.info(f"WebUI output settings before the run: {json.dumps(previous)}")
+        response = requests.post(options_url, json=options)
+        response.raise_for_status()
+    except Exception as e:
+        print(f"Error changing the WebUI output settings: {e}")
+        if previous is not None:
+            restore_webui_options(api_endpoint, previous)
+        return None
+    return previous
+
+def restore_webui_options(api_endpoint, options):
+    try:
+        response = requests.post(f'{api_endpoint}/sdapi/v1/options', json=options)
+        response.raise_for_status()
+    except Exception as e:
+        print(f"Error restoring the WebUI output settings: {e}")
+        print(f"Please restore them in the WebUI settings: {json.dumps(options)}")
+        logging.error(f"Error restoring the WebUI output settings: {e}")
+
+def clear_staging_dir(staging_dir):
+    """Remove files left in the staging folder by an earlier request."""
+    for name in os.listdir(staging_dir):
+        path = os.path.join(staging_dir, name)
+        if os.path.isfile(path):
+            os.remove(path)
+
+def post_txt2img(api_url, headers, payload, settings, cost_model, history_path, staging_dir=None):
+    """Send a txt2img request, record its latency, and return the images.
+
+    Images come back as PNG bytes, or as paths to the files the WebUI saved in
+    staging_dir when it was asked not to send them.
+    """
+    start_time = time.time()
+    response = requests.post(api_url, headers=headers, json=payload)
+    response.raise_for_status()
+    r = response.json()
+    elapsed = time.time() - start_time
+
+    # Record the latency so later runs (and the scheduler) can estimate job cost
+    if history_path:
+        record_generation_history(history_path, {
+            "timestamp": start_time,
+            "backend": settings.api_endpoint,
+            "sampler": settings.sampling_method,
+            "steps": settings.sampling_steps,
+            "width": settings.width,
+            "height": settings.height,
+            "batch_size": payload["batch_size"],
+            "n_iter": payload["n_iter"],
+            "seconds": elapsed
+        })
+    if cost_model is not None:
+        x = cost_features(settings.sampling_steps, settings.width, settings.height, payload["batch_size"], payload["n_iter"])
+        update_cost_model(cost_model, settings.api_endpoint, settings.sampling_method, x, elapsed)
+
+    # Log the response
+    logging.info(f"Response: {response.text}")
+    if r.get('images') or not staging_dir:
+        return [base64.b64decode(img_data) for img_data in r.get('images', [])]
+    # Saved files are numbered in generation order
+    return [os.path.join(staging_dir, f) for f in sorted(os.listdir(staging_dir)) if f.lower().endswith('.png')]
+
+def load_archive_settings(sd_settings):
+    """Return the shard settings for the 'tar' and 'zip' output modes, or None for plain files."""
+    output_mode = sd_settings.get('output_mode', 'files')
+    if output_mode not in ('tar', 'zip'):
+        if output_mode != 'files':
+            print(f"Unknown output_mode '{output_mode}', saving images as files.")
+        return None
+    return {
+        "format": output_mode,
+        "max_bytes": int(float(sd_settings.get('shard_size_mb', 1024)) * 1024 * 1024)
+    }
+
+class ShardWriter:
+    """Stream images of one story into size-bounded tar or zip shards.
+
+    Members are stored uncompressed under their usual relative path (for example
+    Characters/Name/Iteration_1/Name_1_1.png). Every member is also appended to
+    index.jsonl in the shard folder with its shard, byte offset and size, so a
+    single image can be read back with one seek. suspend() closes the files while
+    another story is being generated; the next add() appends to the same shard.
+    """
+
+    def __init__(self, shard_dir, story_name, archive_format, max_bytes):
+        self.shard_dir = shard_dir
+        self.prefix = story_name.replace(' ', '_')
+        self.archive_format = archive_format
+        self.max_bytes = max_bytes
+        os.makedirs(shard_dir, exist_ok=True)
+        # Continue numbering after the highest shard left by earlier runs, even if some were removed
+        shard_pattern = re.compile(re.escape(self.prefix) + r'-(\d+)\.' + archive_format + '$')
+        numbers = [int(match.group(1)) for match in map(shard_pattern.match, os.listdir(shard_dir)) if match]
+        self.shard_number = max(numbers) + 1 if numbers else 0
+        self.archive = None
+        self.shard_name = None
+        self.shard_bytes = 0
+        self.index_file = None
+
+    def _open_shard(self, mode):
+        shard_path = os.path.join(self.shard_dir, self.shard_name)
+        if self.archive_format == 'tar':
+            self.archive = tarfile.open(shard_path, mode, format=tarfile.PAX_FORMAT)
+        else:
+            self.archive = zipfile.ZipFile(shard_path, mode, compression=zipfile.ZIP_STORED)
+
+    def _start_shard(self):
+        self.shard_name = f"{self.prefix}-{self.shard_number:05d}.{self.archive_format}"
+        self.shard_number += 1
+        self.shard_bytes = 0
+        self._open_shard('w')
+
+    def _close_shard(self):
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+
+    def add(self, source, arcname):
+        """Add PNG bytes, or the file at a path, to the current shard as arcname."""
+        if isinstance(source, bytes):
+            data = source
+        else:
+            with open(source, 'rb') as f:
+                data = f.read()
+        if self.shard_name is not None and self.shard_bytes and self.shard_bytes + len(data) > self.max_bytes:
+            self._close_shard()
+            self.shard_name = None
+        if self.shard_name is None:
+            self._start_shard()
+        elif self.archive is None:
+            # Resume the shard this story was writing before it was suspended
+            self._open_shard('a')
+        if self.index_file is None:
+            self.index_file = open(os.path.join(self.shard_dir, 'index.jsonl'), 'a', encoding='utf-8')
+
+        if self.archive_format == 'tar':
+            tarinfo = tarfile.TarInfo(arcname)
+            tarinfo.size = len(data)
+            tarinfo.mtime = time.time()
+            self.archive.addfile(tarinfo, io.BytesIO(data))
+            # Data ends at the current offset, padded to whole 512-byte blocks
+            offset = self.archive.offset - -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        else:
+            zipinfo = zipfile.ZipInfo(arcname, time.localtime()[:6])
+            self.archive.writestr(zipinfo, data, compress_type=zipfile.ZIP_STORED)
+            # Data follows the 30-byte local header, the file name and the extra field
+            offset = zipinfo.header_offset + 30 + len(zipinfo.filename.encode('utf-8')) + len(zipinfo.extra)
+        self.shard_bytes += len(data)
+
+        # Make sure the data is written before the index points at it
+        if self.archive_format == 'tar':
+            self.archive.fileobj.flush()
+        else:
+            self.archive.fp.flush()
+        self.index_file.write(json.dumps({
+            "name": arcname,
+            "shard": self.shard_name,
+            "offset": offset,
+            "size": len(data)
+        }) + '\n')
+        self.index_file.flush()
+
+    def suspend(self):
+        """Close the open files, keeping the position so writing can resume later."""
+        self._close_shard()
+        if self.index_file is not None:
+            self.index_file.close()
+            self.index_file = None
+
+    def close(self):
+        self.suspend()
+        self.shard_name = None
+
+def extract_shards(shard_dir, dest_dir, pattern=None):
+    """Extract images listed in a shard folder's index.jsonl, optionally only names matching pattern."""
+    index_path = os.path.join(shard_dir, 'index.jsonl')
+    if not os.path.exists(index_path):
+        # Accept the story folder as well as its shards folder
+        shard_dir = os.path.join(shard_dir, 'shards')
+        index_path = os.path.join(shard_dir, 'index.jsonl')
+    if not os.path.exists(index_path):
+        print(f"No shard index found in '{shard_dir}'.")
+        return 0
+
+    extracted = 0
+    shard_files = {}
+    try:
+        with open(index_path, 'r', encoding='utf-8') as index_file:
+            for line_number, line in enumerate(index_file, start=1):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Most likely a line cut short by a crash while it was being written
+                    print(f"Skipping unreadable line {line_number} of '{index_path}'.")
+                    continue
+                if pattern and not fnmatch.fnmatch(entry['name'], pattern):
+                    continue
+                if entry['shard'] not in shard_files:
+                    shard_files[entry['shard']] = open(os.path.join(shard_dir, entry['shard']), 'rb')
+                shard_file = shard_files[entry['shard']]
+                shard_file.seek(entry['offset'])
+                data = shard_file.read(entry['size'])
+
+                dest_path = os.path.join(dest_dir, *entry['name'].split('/'))
+                os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+                with open(dest_path, 'wb') as f:
+                    f.write(data)
+                extracted += 1
+    finally:
+        for shard_file in shard_files.values():
+            shard_file.close()
+    return extracted
+
+def generate_images(settings, jobs, selected_loras, num_iterations, cost_model=None, history_path=None,
+                    quality=None, quality_report=None, staging_dir=None, archive=None, output_dir=None):
+    api_url = (settings.api_endpoint or 'http://localhost:7860') + '/sdapi/v1/txt2img'
+    headers = {'Content-Type': 'application/json'}
+    if quality_report is None:
+        quality_report = new_quality_report()
+
+    current_story = None
+    current_item = None
+    # Perceptual hashes of the images kept so far for the current item. An item's
+    # jobs always arrive together, so only one item's hashes are held at a time.
+    item_hashes = np.zeros((0, 8), dtype=np.uint8)
+    job_count = 0
+    # One writer per story, kept so a story revisited by the scheduler continues its shard
+    shard_writers = {}
+    shard_writer = None
+    started_stories = set()
+    try:
+        for job in jobs:
+            if job.story_name != current_story:
+                if current_story is not None:
+                    print(f"\nImage generation completed for folder: {current_story}")
+                    if shard_writer is not None:
+                        shard_writer.suspend()
+                current_story = job.story_name
+                if current_story in started_stories:
+                    print(f"\nContinuing folder: {current_story}")
+                else:
+                    started_stories.add(current_story)
+                    print(f"\nProcessing folder: {current_story}")
+                if archive is not None:
+                    if current_story not in shard_writers:
+                        shard_writers[current_story] = ShardWriter(os.path.join(output_dir, current_story, 'shards'),
+                                                                   current_story, archive["format"], archive["max_bytes"])
+                    shard_writer = shard_writers[current_story]
+            if job.item_dir != current_item:
+                current_item = job.item_dir
+                item_hashes = np.zeros((0, 8), dtype=np.uint8)
+                print_item_settings(settings, job, num_iterations, selected_loras)
+            job_count += 1
+
+            item_name = job.item_name
+            iteration = job.iteration
+            iteration_dir = os.path.join(job.item_dir, f'Iteration_{iteration}')
+            if shard_writer is None:
+                os.makedirs(iteration_dir, exist_ok=True)
+
+            # Image numbers still to be produced, and the seed to request them with
+            pending = list(range(1, job.num_images + 1))
+            seed = job.seed
+            attempt = 0
+            while pending:
+                # Check for pause
+                while paused:
+                    time.sleep(0.5)
+
+                payload = {
+                    "prompt": job.prompt,
+                    "negative_prompt": job.negative_prompt,
+                    "steps": settings.sampling_steps,
+                    "cfg_scale": settings.cfg_scale,
+                    "width": settings.width,
+                    "height": settings.height,
+                    "sampler_name": settings.sampling_method,
+                    "seed": seed,
+                    "batch_size": 1,
+                    "n_iter": len(pending),
+                    "scheduler": settings.scheduler,
+                    "override_settings": {
+                        "sd_model_checkpoint": settings.model
+                    }
                 }
-            }
 
-            # Log the payload
-            logging.info(f"Generating images for {item_name}, Iteration {iteration}")
-            logging.info(f"Payload: {json.dumps(payload, indent=4)}")
+                request_payload = payload
+                if staging_dir:
+                    # Have the WebUI save the PNGs in the staging folder instead of sending them back as base64
+                    clear_staging_dir(staging_dir)
+                    request_payload = dict(payload, save_images=True, send_images=False)
 
-            print(f"\nIteration {iteration}: Generating {num_images} images...")
-            try:
-                response = requests.post(api_url, headers=headers, json=payload)
-                response.raise_for_status()
-                r = response.json()
-
-                # Log the response
-                logging.info(f"Response: {response.text}")
-
-                for idx, img_data in enumerate(tqdm(r['images'], desc=f"Saving images for {item_name}")):
-                    img_bytes = base64.b64decode(img_data)
-                    img_path = os.path.join(iteration_dir, f'{item_name}_{iteration}_{idx + 1}.png')
-                    with open(img_path, 'wb') as img_file:
-                        img_file.write(img_bytes)
+                # Log the payload
+                logging.info(f"Generating images for {item_name}, Iteration {iteration}")
+                logging.info(f"Payload: {json.dumps(request_payload, indent=4)}")
+
+                if attempt == 0:
+                    print(f"\nIteration {iteration}: Generating {len(pending)} images...")
+                else:
+                    print(f"Iteration {iteration}: Regenerating {len(pending)} missing or degenerate image(s) with seed {seed}...")
+                try:
+                    images = post_txt2img(api_url, headers, request_payload, settings, cost_model, history_path, staging_dir)
+                    if staging_dir and len(images) != len(pending):
+                        # The WebUI saved elsewhere (or not at all); fetch the images over the API instead
+                        message = (f"Expected {len(pending)} image(s) in the staging folder for {item_name}, Iteration {iteration}, "
+                                   f"but found {len(images)}. Requesting them over the API and disabling co-located mode.")
+                        print(message)
+                        logging.warning(message)
+                        clear_staging_dir(staging_dir)
+                        staging_dir = None
+                        logging.info(f"Payload: {json.dumps(payload, indent=4)}")
+                        images = post_txt2img(api_url, headers, payload, settings, cost_model, history_path)
+                except requests.exceptions.RequestException as e:
+                    print(f"Error generating images for {item_name} in iteration {iteration}: {e}")
+                    logging.error(f"Error generating images for {item_name} in iteration {iteration}: {e}")
+                    break
+
+                retry = []
+                if len(images) != len(pending):
+                    message = f"Expected {len(pending)} image(s) for {item_name}, Iteration {iteration}, but received {len(images)}"
+                    print(message)
+                    logging.warning(message)
+                    # Missing images are requested again like degenerate ones
+                    retry.extend(pending[len(images):])
+                    images = images[:len(pending)]
+                degenerate = duplicate = [False] * len(images)
+                if quality is not None and images:
+                    degenerate, duplicate, hashes = check_image_quality(images, item_hashes, quality)
+                    kept = ~(degenerate | duplicate)
+                    item_hashes = np.concatenate([item_hashes, hashes[kept]])
+                    quality_report["checked"] += len(images)
+
+                for number, image, is_degenerate, is_duplicate in zip(
+                        pending, tqdm(images, desc=f"Saving images for {item_name}"), degenerate, duplicate):
+                    if is_degenerate:
+                        retry.append(number)
+                        continue
+                    if is_duplicate:
+                        quality_report["duplicates"] += 1
+                        logging.info(f"Collapsed near-duplicate image {number} of {item_name}, Iteration {iteration}")
+                        continue
+                    img_path = os.path.join(iteration_dir, f'{item_name}_{iteration}_{number}.png')
+                    if shard_writer is not None:
+                        arcname = os.path.relpath(img_path, os.path.join(output_dir, current_story))
+                        shard_writer.add(image, arcname.replace(os.sep, '/'))
+                    else:
+                        save_image(image, img_path)
+
+                max_retries = quality["max_retries"] if quality is not None else 0
+                if retry and attempt < max_retries:
+                    quality_report["requeued"] += len(retry)
+                    logging.info(f"Re-queueing {len(retry)} missing or degenerate image(s) of {item_name}, Iteration {iteration}")
+                    attempt += 1
+                    seed = random.randint(0, 2 ** 32 - 1)
+                    pending = sorted(retry)
+                    continue
+                if retry:
+                    quality_report["dropped"] += len(retry)
+                    print(f"Iteration {iteration}: Dropped {len(retry)} missing or degenerate image(s) for {item_name} after {attempt} retries")
+                    logging.warning(f"Dropped {len(retry)} missing or degenerate image(s) of {item_name}, Iteration {iteration}")
                 print(f"Iteration {iteration}: Completed generating images for {item_name}")
-            except requests.exceptions.RequestException as e:
-                print(f"Error generating images for {item_name} in iteration {iteration}: {e}")
-                logging.error(f"Error generating images for {item_name} in iteration {iteration}: {e}")
-                continue
+                pending = []
 
             # Check for pause
             while paused:
                 time.sleep(0.5)
 
+        if current_story is not None:
+            print(f"\nImage generation completed for folder: {current_story}")
+    finally:
+        for writer in shard_writers.values():
+            writer.close()
+    return job_count
+
+def print_quality_report(report):
+    if not report["checked"]:
+        return
+    print("\nQuality gate summary:")
+    print(f"  Images checked: {report['checked']}")
+    print(f"  Degenerate images re-queued: {report['requeued']}")
+    print(f"  Degenerate images dropped after retries: {report['dropped']}")
+    print(f"  Near-duplicates collapsed: {report['duplicates']}")
+
 def main():
+    parser = argparse.ArgumentParser(description='Generate character and scene images with the Stable Diffusion web UI.')
+    parser.add_argument('--extract', metavar='FOLDER', help='extract images from the tar/zip shards of a story output folder and exit')
+    parser.add_argument('--dest', metavar='FOLDER', help='where to extract images to (default: the story output folder)')
+    parser.add_argument('--match', metavar='PATTERN', help="only extract images whose path matches this pattern, e.g. 'Scenes/Scene_001/*'")
+    args = parser.parse_args()
+
+    if args.extract:
+        dest_dir = args.dest or args.extract
+        extracted = extract_shards(args.extract, dest_dir, args.match)
+        print(f"Extracted {extracted} images to '{dest_dir}'.")
+        return
+
     # Configure logging
     logging.basicConfig(filename='generation_log.txt', level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
 
@@ -372,8 +1459,13 @@ def main():
     # Detect available LoRAs
     available_loras = get_available_loras(lora_dir)
 
+    # Read LoRA metadata, using the cached index for files that have not changed
+    model_index_path = os.path.join(script_dir, 'settings', 'model_index.json')
+    model_index = load_model_index(model_index_path)
+    lora_infos = index_model_files(lora_dir, available_loras, model_index)
+
     # Prompt user to select LoRAs
-    selected_loras = select_loras(available_loras)
+    selected_loras = select_loras(available_loras, lora_infos)
 
     # Get list of folders in the input directory
     available_folders = [d for d in os.listdir(input_dir) if os.path.isdir(os.path.join(input_dir, d))]
@@ -413,10 +1505,13 @@ def main():
         print(f"No models found in '{models_path}'.")
         sys.exit(1)
 
+    model_infos = index_model_files(models_path, models, model_index)
+    save_model_index(model_index_path, model_index)
+
     # Select model
     print("\nAvailable Models:")
     for idx, model in enumerate(models):
-        print(f"{idx + 1}: {model}")
+        print(f"{idx + 1}: {model}{format_model_info(model_infos.get(model))}")
     while True:
         try:
             model_choice = int(input("Select a model by number: ")) - 1
@@ -472,7 +1567,7 @@ def main():
 
     # Prompt user to select LoRAs and assign weights
     print("\n--- LoRA Selection ---")
-    selected_loras = select_loras(available_loras)
+    selected_loras = select_loras(available_loras, lora_infos)
 
     # Ask for other settings
     while True:
@@ -496,6 +1591,17 @@ def main():
         except ValueError:
             print("Please enter a valid integer for height.")
 
+    # Validate LoRA and resolution compatibility before anything is sent to the backend
+    compatibility_warnings = check_model_compatibility(model, model_infos.get(model), selected_loras, lora_infos, width, height)
+    if compatibility_warnings:
+        print("\nCompatibility warnings:")
+        for warning in compatibility_warnings:
+            print(f"  - {warning}")
+            logging.warning(warning)
+        if input("Continue anyway? (y/n, default n): ").strip().lower() != 'y':
+            print("Aborted.")
+            sys.exit(0)
+
     while True:
         try:
             cfg_scale = float(input("Enter the CFG scale (default 7.5): ").strip() or 7.5)
@@ -532,67 +1638,87 @@ def main():
         except ValueError:
             print("Please enter a valid integer for number of iterations.")
 
-    # Create settings dictionary
-    settings = {
-        "model": model,
-        "sampling_method": sampling_method,
-        "scheduler": scheduler,
-        "sampling_steps": sampling_steps,
-        "width": width,
-        "height": height,
-        "cfg_scale": cfg_scale,
-        "seed": seed,
-        "api_endpoint": api_endpoint
-    }
-
-    # Process each selected folder
-    for story_name in selected_folders:
-        folder_path = os.path.join(input_dir, story_name)
-        print(f"\nProcessing folder: {story_name}")
-
-        # Output folder for this story
-        story_output_dir = os.path.join(output_dir, story_name)
-
-        # Process prompts and generate JSON files
-        print("\nProcessing character prompts...")
-        character_prompts = create_prompts('character', folder_path)
-        if not character_prompts:
-            print("No character prompts found. Skipping character image generation.")
-        else:
-            character_json_files = generate_json_files(character_prompts, 'character', story_name, settings['seed'], num_images, num_iterations, output_dir)
-
-        print("\nProcessing scene prompts...")
-        scene_prompts = create_prompts('scene', folder_path)
-        if not scene_prompts:
-            print("No scene prompts found. Skipping scene image generation.")
+    while True:
+        try:
+            time_budget_input = input("Enter a time budget in minutes (leave blank for no limit): ").strip()
+            time_budget = float(time_budget_input) if time_budget_input else None
+            if time_budget is None or time_budget > 0:
+                break
+            else:
+                print("Time budget must be positive.")
+        except ValueError:
+            print("Please enter a valid number of minutes.")
+
+    # Settings shared by every job in the run
+    settings = GenerationSettings(
+        model=model,
+        sampling_method=sampling_method,
+        scheduler=scheduler,
+        sampling_steps=sampling_steps,
+        width=width,
+        height=height,
+        cfg_scale=cfg_scale,
+        seed=seed,
+        api_endpoint=api_endpoint
+    )
+
+    # Jobs are expanded lazily while images are generated
+    jobs = iter_jobs(settings, selected_folders, input_dir, output_dir, num_images, num_iterations, selected_loras)
+
+    # Check prompt lengths against the CLIP chunk size, optionally removing duplicate phrases
+    dedupe_prompts = bool(sd_settings.get('dedupe_prompts', False))
+    prompt_budget_report = new_prompt_budget_report()
+    jobs = analyze_prompt_budget(jobs, dedupe_prompts, prompt_budget_report)
+
+    # Latency history feeds the cost model used by the time budget scheduler
+    history_path = os.path.join(script_dir, 'settings', 'generation_history.jsonl')
+    cost_model = load_cost_model(history_path)
+    if time_budget is not None:
+        jobs = schedule_jobs(jobs, settings, cost_model, time.time() + time_budget * 60)
+
+    # When the WebUI runs on this machine it saves images to disk itself
+    staging_dir = None
+    webui_options = None
+    if is_colocated(sd_settings, api_endpoint):
+        staging_dir = os.path.join(output_dir, '.staging')
+        os.makedirs(staging_dir, exist_ok=True)
+        webui_options = set_colocated_output(api_endpoint, staging_dir)
+        if webui_options is None:
+            print("Images will be sent over the API instead.")
+            os.rmdir(staging_dir)
+            staging_dir = None
         else:
-            scene_json_files = generate_json_files(scene_prompts, 'scene', story_name, settings['seed'], num_images, num_iterations, output_dir)
+            print("\nWebUI is running on this machine: images will be saved by the WebUI and moved into place.")
+            print("Its output folder settings are changed for this run and restored afterwards.")
 
-        print("\nJSON files for characters and scenes have been created.")
-        print("You can review and edit them before proceeding if needed.")
+    # Stream images into tar/zip shards instead of individual files if configured
+    archive = load_archive_settings(sd_settings)
+    if archive is not None:
+        print(f"\nImages will be written to {archive['format']} shards of up to {archive['max_bytes'] // (1024 * 1024)} MB per story.")
 
-        # Start keyboard listener
-        print("Press 'F8' at any time to pause/resume the script during image generation.")
-        start_keyboard_listener()
-
-        # Generate images for characters
-        if character_prompts:
-            print("\nStarting image generation for characters...")
-            generate_images(settings, 'character', story_name, num_images, num_iterations, output_dir, character_prompts, selected_loras, lora_dir)
-        else:
-            print("No character prompts to process.")
-
-        # Generate images for scenes
-        if scene_prompts:
-            print("\nStarting image generation for scenes...")
-            generate_images(settings, 'scene', story_name, num_images, num_iterations, output_dir, scene_prompts, selected_loras, lora_dir)
-        else:
-            print("No scene prompts to process.")
+    # Thresholds for rejecting black, blank and near-duplicate images
+    quality = load_quality_settings(sd_settings)
+    quality_report = new_quality_report()
 
+    # Start keyboard listener
+    print("\nPress 'F8' at any time to pause/resume the script during image generation.")
+    start_keyboard_listener()
+    try:
+        job_count = generate_images(settings, jobs, selected_loras, num_iterations, cost_model, history_path,
+                                    quality, quality_report, staging_dir, archive, output_dir)
+    finally:
         # Stop keyboard listener after image generation
         stop_keyboard_listener()
+        if webui_options is not None:
+            restore_webui_options(api_endpoint, webui_options)
+            # Anything left behind was rejected by the quality gate
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    print_prompt_budget_report(prompt_budget_report, dedupe_prompts)
+    print_quality_report(quality_report)
 
-        print(f"\nImage generation completed for folder: {story_name}")
+    if not job_count:
+        print("No character or scene prompts found in the selected folders.")
 
 if __name__ == '__main__':
     main()